@@ -6,9 +6,11 @@
 # of patent rights can be found in the PATENTS file in the same directory.
 
 from __future__ import print_function
-import math, sys, random, argparse, json, os, tempfile
+import math, sys, random, argparse, json, os, tempfile, functools, logging, pathlib
 from datetime import datetime as dt
-from collections import Counter
+from collections import Counter, namedtuple
+
+import numpy as np
 
 """
 Renders random scenes using Blender, each with with a random number of objects;
@@ -22,6 +24,16 @@ This file expects to be run from Blender like this:
 blender --background --python render_images.py -- [arguments to this script]
 """
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 INSIDE_BLENDER = True
 try:
     import bpy, bpy_extras
@@ -41,6 +53,8 @@ if INSIDE_BLENDER:
         print("$VERSION is your Blender version (such as 2.78).")
         sys.exit(1)
 
+logger = logging.getLogger(__name__)
+
 parser = argparse.ArgumentParser()
 
 # Input options
@@ -71,9 +85,9 @@ parser.add_argument('--max_objects', default=10, type=int,
 parser.add_argument('--min_dist', default=0.25, type=float,
                     help="The minimum allowed distance between object centers")
 parser.add_argument('--margin', default=0.4, type=float,
-                    help="Along all cardinal directions (left, right, front, back), all " +
-                         "objects will be at least this distance apart. This makes resolving " +
-                         "spatial relationships slightly less ambiguous.")
+                    help="Currently ignored. Intended as the minimum distance between " +
+                         "objects along all cardinal directions (left, right, front, back), " +
+                         "but object placement only enforces --min_dist.")
 parser.add_argument('--min_pixels_per_object', default=200, type=int,
                     help="All objects will have at least this many visible pixels in the " +
                          "final rendered images; this ensures that no objects are fully " +
@@ -88,7 +102,9 @@ parser.add_argument('--start_idx', default=0, type=int,
                          "this to non-zero values allows you to distribute rendering across " +
                          "multiple machines and recombine the results later.")
 parser.add_argument('--num_images', default=5, type=int,
-                    help="The number of images to render")
+                    help="The number of scenes to render. The base scene is loaded once and " +
+                         "reused for all of them. Each scene is written to its own subdirectory " +
+                         "of --output_dir.")
 parser.add_argument('--num_cams', default=1, type=int,
                     help="The number of cameras for each scene to render")
 parser.add_argument('--filename_prefix', default='CLEVR',
@@ -98,6 +114,10 @@ parser.add_argument('--split', default='new',
                          "the names of rendered images, and will also be stored in the JSON " +
                          "scene structure for each image.")
 parser.add_argument('--output_dir', default=bpy.path.abspath('//output'), help='Working directory')
+parser.add_argument('--output_format', default='png', choices=['png', 'jpg'],
+                    help="File format of the rendered images. PNGs are written with fast, " +
+                         "light compression; JPEGs (quality 95) are faster to write and " +
+                         "smaller still.")
 parser.add_argument('--save_blendfiles', type=int, default=0,
                     help="Setting --save_blendfiles 1 will cause the blender scene file for " +
                          "each generated image to be stored in the directory specified by " +
@@ -108,15 +128,31 @@ parser.add_argument('--version', default='1.0',
 parser.add_argument('--license',
                     default="Creative Commons Attribution (CC-BY 4.0)",
                     help="String to store in the \"license\" field of the generated JSON file")
+parser.add_argument('--verbose', default=0, type=int,
+                    help="Setting --verbose 1 logs progress information such as camera " +
+                         "positions and the number of tries needed to place each object.")
 parser.add_argument('--date', default=dt.today().strftime("%m/%d/%Y"),
                     help="String to store in the \"date\" field of the generated JSON file; " +
                          "defaults to today's date")
 
 # Rendering options
 parser.add_argument('--use_gpu', default=0, type=int,
-                    help="Setting --use_gpu 1 enables GPU-accelerated rendering using CUDA. " +
-                         "You must have an NVIDIA GPU with the CUDA toolkit installed for " +
-                         "to work.")
+                    help="Setting --use_gpu 1 enables GPU-accelerated rendering with Cycles. " +
+                         "OptiX is preferred when available, falling back to CUDA, HIP, " +
+                         "Metal and oneAPI in that order.")
+parser.add_argument('--gpu_index', default=None, type=int,
+                    help="If given together with --use_gpu 1, only render on the GPU with " +
+                         "this index instead of on all available GPUs.")
+parser.add_argument('--num_shards', default=1, type=int,
+                    help="Split the camera views of each scene into this many shards, so " +
+                         "that several Blender processes (e.g. one per GPU) can render the " +
+                         "same scene in parallel. See render_multi_gpu.sh.")
+parser.add_argument('--shard_index', default=0, type=int,
+                    help="Index of the shard rendered by this process; it renders every " +
+                         "view whose index modulo --num_shards equals this value.")
+parser.add_argument('--seed', default=None, type=int,
+                    help="Optional seed for the random number generator. All shards of a " +
+                         "scene must use the same seed so that they render the same scene.")
 parser.add_argument('--width', default=320, type=int,
                     help="The width (in pixels) for the rendered images")
 parser.add_argument('--height', default=240, type=int,
@@ -127,13 +163,16 @@ parser.add_argument('--fill_light_jitter', default=1.0, type=float,
                     help="The magnitude of random jitter to add to the fill light position.")
 parser.add_argument('--back_light_jitter', default=1.0, type=float,
                     help="The magnitude of random jitter to add to the back light position.")
-parser.add_argument('--render_num_samples', default=512, type=int,
-                    help="The number of samples to use when rendering. Larger values will " +
-                         "result in nicer images but will cause rendering to take longer.")
-parser.add_argument('--render_min_bounces', default=8, type=int,
-                    help="The minimum number of bounces to use for rendering.")
-parser.add_argument('--render_max_bounces', default=8, type=int,
-                    help="The maximum number of bounces to use for rendering.")
+parser.add_argument('--render_num_samples', default=64, type=int,
+                    help="The maximum number of samples to use when rendering. Larger values " +
+                         "will result in nicer images but will cause rendering to take longer. " +
+                         "Images are denoised and adaptively sampled, so few samples suffice " +
+                         "for CLEVR scenes.")
+parser.add_argument('--render_min_bounces', default=0, type=int,
+                    help="The minimum number of transparent bounces to use for rendering. " +
+                         "CLEVR scenes contain no transparent objects, so this defaults to 0.")
+parser.add_argument('--render_max_bounces', default=0, type=int,
+                    help="The maximum number of transparent bounces to use for rendering.")
 parser.add_argument('--render_tile_size', default=256, type=int,
                     help="The tile size to use for rendering. This should not affect the " +
                          "quality of the rendered image but may affect the speed; CPU-based " +
@@ -142,82 +181,153 @@ parser.add_argument('--render_tile_size', default=256, type=int,
 
 
 def listify_matrix(matrix):
-    matrix_list = []
-    for row in matrix:
-        matrix_list.append(list(row))
-    return matrix_list
+    return np.asarray(matrix).tolist()
 
 
-def main(args):
-    output_image_dir = os.path.join(args.output_dir, 'images')
-    output_blend_dir = os.path.join(args.output_dir, 'blendfiles')
-    num_digits = 6
-    prefix = '%s_%s_' % (args.filename_prefix, args.split)
-    img_template = '%s%%0%dd.png' % (prefix, num_digits)
-    blend_path = f"{prefix[:-1]}.blend"
-    img_template = os.path.join(output_image_dir, img_template)
-    blend_path = os.path.join(output_blend_dir, blend_path)
-
-    if not os.path.isdir(output_image_dir):
-        os.makedirs(output_image_dir)
-    if args.save_blendfiles == 1 and not os.path.isdir(output_blend_dir):
-        os.makedirs(output_blend_dir)
-
-    num_objects = random.randint(args.min_objects, args.max_objects)
-    render_scene(args,
-                 num_objects=num_objects,
-                 output_split=args.split,
-                 image_template=img_template,
-                 output_blendfile=blend_path if args.save_blendfiles == 1 else None
-                 )
-
+def write_json(path, data):
+    """
+  Write data as JSON to path, using orjson if it is installed. The data is
+  first written to a temporary file that is then renamed over path, so a
+  crashed job never leaves a partially written file behind.
+  """
+    path = pathlib.Path(path)
+    tmp_path = path.with_name(path.name + '.tmp')
+    if orjson is not None:
+        tmp_path.write_bytes(orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY))
+    else:
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, indent=2)
+    os.replace(tmp_path, path)
 
-def render_scene(args,
-                 num_objects=5,
-                 output_index=0,
-                 output_split='none',
-                 image_template = '%d',
-                 output_blendfile=None
-                 ):
-    out_data = {'camera_angle_x': bpy.data.objects['Camera'].data.angle_x, 'frames': []}
 
-    out_data['frames'] = []
-    # Load the main blendfile
+def main(args):
+    logging.basicConfig(level=logging.WARNING)
+    # Only this script's messages get more verbose, not those of its libraries
+    logger.setLevel(logging.DEBUG if args.verbose == 1 else logging.WARNING)
+    if not 0 <= args.shard_index < args.num_shards:
+        raise ValueError('--shard_index must be in [0, %d)' % args.num_shards)
+    if args.num_shards > 1 and args.seed is None:
+        # Otherwise every shard would render a different random scene
+        raise ValueError('--seed is required when --num_shards is greater than 1')
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    # Load the main blendfile once; scenes only add and remove objects
     bpy.ops.wm.open_mainfile(filepath=args.base_scene_blendfile)
 
-    # Load materials
+    # Load materials and shapes
     utils.load_materials(os.path.join(args.output_dir, args.material_dir))
+    utils.load_shapes(os.path.join(args.output_dir, args.shape_dir))
 
     # Set render arguments so we can get pixel coordinates later.
     # We use functionality specific to the CYCLES renderer so BLENDER_RENDER
     # cannot be used.
     render_args = bpy.context.scene.render
-    render_args.engine = "BLENDER_EEVEE"
+    render_args.engine = "CYCLES"
 
     render_args.resolution_x = args.width
     render_args.resolution_y = args.height
     render_args.resolution_percentage = 100
+    # The format must be set first; the allowed color modes and depths depend on it
+    image_settings = render_args.image_settings
+    image_settings.file_format = 'JPEG' if args.output_format == 'jpg' else 'PNG'
+    image_settings.color_mode = 'RGB'
+    image_settings.color_depth = '8'
+    if args.output_format == 'jpg':
+        image_settings.quality = 95
+    else:
+        # Low zlib level; encoding is much faster for a slightly larger file
+        image_settings.compression = 15
+    device_type = None
     if args.use_gpu == 1:
-        cycles_prefs = bpy.context.preferences.addons['cycles'].preferences
-        cycles_prefs.compute_device_type = 'CUDA'
+        # Prefers OptiX, then CUDA, then HIP / Metal / oneAPI
+        device_type = utils.enable_gpus(gpu_index=args.gpu_index)
 
     # Some CYCLES-specific stuff
-    bpy.context.scene.cycles.tile_x = args.render_tile_size
-    bpy.context.scene.cycles.tile_y = args.render_tile_size
+    if bpy.app.version < (3, 0, 0):
+        # Cycles X (Blender 3.0+) picks tile sizes itself
+        bpy.context.scene.cycles.tile_x = args.render_tile_size
+        bpy.context.scene.cycles.tile_y = args.render_tile_size
     bpy.data.worlds['World'].cycles.sample_as_light = True
     bpy.context.scene.cycles.blur_glossy = 2.0
     bpy.context.scene.cycles.samples = args.render_num_samples
+    # Stop sampling pixels early once they have converged, and denoise the result
+    bpy.context.scene.cycles.use_adaptive_sampling = True
+    bpy.context.scene.cycles.adaptive_threshold = 0.01
+    bpy.context.scene.cycles.adaptive_min_samples = 16
+    bpy.context.scene.cycles.use_denoising = True
+    if device_type == 'OPTIX':
+        bpy.context.scene.cycles.denoiser = 'OPTIX'
+    else:
+        bpy.context.scene.cycles.denoiser = 'OPENIMAGEDENOISE'
     bpy.context.scene.cycles.transparent_min_bounces = args.render_min_bounces
     bpy.context.scene.cycles.transparent_max_bounces = args.render_max_bounces
-    if args.use_gpu == 1:
-        bpy.context.scene.cycles.device = 'GPU'
+    # CLEVR materials are opaque rubber and metal with no volumes, so only
+    # diffuse and glossy bounces contribute to the image
+    bpy.context.scene.cycles.transmission_bounces = 0
+    bpy.context.scene.cycles.volume_bounces = 0
+    bpy.context.scene.cycles.diffuse_bounces = 3
+    bpy.context.scene.cycles.glossy_bounces = 4
+
+    num_digits = 6
+    prefix = f'{args.filename_prefix}_{args.split}_'
+    # Blender replaces the run of '#' with the zero-padded frame (view) number
+    img_name = f'{prefix}{"#" * num_digits}.{args.output_format}'
+    blend_name = f'{prefix[:-1]}.blend'
+    output_dir = pathlib.Path(args.output_dir)
+
+    for i in range(args.start_idx, args.start_idx + args.num_images):
+        # Every scene gets its own subdirectory, however many are rendered
+        scene_dir = output_dir / f'{prefix}{i:0{num_digits}d}'
+        output_image_dir = scene_dir / 'images'
+        output_blend_dir = scene_dir / 'blendfiles'
+
+        output_image_dir.mkdir(parents=True, exist_ok=True)
+        if args.save_blendfiles == 1:
+            output_blend_dir.mkdir(parents=True, exist_ok=True)
+
+        num_objects = random.randint(args.min_objects, args.max_objects)
+        render_scene(args,
+                     num_objects=num_objects,
+                     output_index=i,
+                     output_split=args.split,
+                     output_dir=os.fspath(scene_dir),
+                     image_template=os.fspath(output_image_dir / img_name),
+                     output_blendfile=(os.fspath(output_blend_dir / blend_name)
+                                       if args.save_blendfiles == 1 else None)
+                     )
+
+
+def render_scene(args,
+                 num_objects=5,
+                 output_index=0,
+                 output_split='none',
+                 output_dir='output',
+                 image_template='######',
+                 output_blendfile=None
+                 ):
+    """
+  Render all camera views of one random scene into the base scene loaded by
+  main. The objects added to the scene are removed and the lamps are moved
+  back to their original positions before returning.
+  """
+    render_args = bpy.context.scene.render
+
+    # Look up the camera and lamps once; every lookup by name crosses into C
+    camera = bpy.data.objects['Camera']
+    lamp_key = bpy.data.objects['Lamp_Key']
+    lamp_back = bpy.data.objects['Lamp_Back']
+    lamp_fill = bpy.data.objects['Lamp_Fill']
+    lamp_rest_locations = [(lamp, lamp.location.copy()) for lamp in (lamp_key, lamp_back, lamp_fill)]
+
+    out_data = {'camera_angle_x': camera.data.angle_x, 'frames': []}
 
     # This will give ground-truth information about the scene and its objects
     scene_struct = {
         'split': output_split,
         'image_index': output_index,
         'image_filename': None,
-        'objects': [],
+        'objects': None,
         'directions': {},
     }
 
@@ -226,160 +336,257 @@ def render_scene(args,
 
     # Add random jitter to lamp positions
 
+    def rand_vector(L):
+        return Vector((rand(L), rand(L), rand(L)))
+
     if args.key_light_jitter > 0:
-        for i in range(3):
-            bpy.data.objects['Lamp_Key'].location[i] += rand(args.key_light_jitter)
+        lamp_key.location += rand_vector(args.key_light_jitter)
     if args.back_light_jitter > 0:
-        for i in range(3):
-            bpy.data.objects['Lamp_Back'].location[i] += rand(args.back_light_jitter)
+        lamp_back.location += rand_vector(args.back_light_jitter)
     if args.fill_light_jitter > 0:
-        for i in range(3):
-            bpy.data.objects['Lamp_Fill'].location[i] += rand(args.fill_light_jitter)
-
-    camera = bpy.data.objects['Camera']
+        lamp_fill.location += rand_vector(args.fill_light_jitter)
 
-    objects = None
-    num_heights = 8
+    # Never use more heights than cameras, otherwise no view would be rendered
+    num_heights = min(8, args.num_cams)
+    cams_per_height = args.num_cams // num_heights
 
     stepsize = 360.0 / args.num_cams * num_heights
     # rotation_mode = 'XYZ'
 
-    for j in range(num_heights):
-        phi = math.pi*3/10/num_heights*(j+1)
-        bpy.data.objects['Camera'].location[2] = 10 * math.cos(phi)
-        for i in range(args.num_cams//num_heights):
-            render_args.filepath = image_template % (args.num_cams//num_heights*j+i)
-            # set camera position
-            bpy.data.objects['Camera'].location[0] = 10 * math.cos((2 * i - 1) / args.num_cams * num_heights * math.pi) * math.sin(
-                phi)
-            bpy.data.objects['Camera'].location[1] = 10 * math.sin((2 * i - 1) / args.num_cams * num_heights * math.pi) * math.sin(
-                phi)
-            print(bpy.data.objects['Camera'].location)
-
-            if len(bpy.data.objects) == 7:
-                # Now make some random objects
-                objects, blender_objects = add_random_objects(num_objects, args, camera)
-
-            while True:
-                try:
-                    bpy.ops.render.render(write_still=True)
-                    cam = bpy.data.objects['Camera']
-                    frame_data = {
-                        'file_path': os.path.relpath(bpy.context.scene.render.filepath, args.output_dir),
-                        'rotation': math.radians(stepsize),
-                        'transform_matrix': listify_matrix(cam.matrix_world)
-                    }
-                    break
-                except Exception as e:
-                    print(e)
+    # Elevation of each camera ring and azimuth of each camera within a ring
+    phis = math.pi * 3 / 10 / num_heights * np.arange(1, num_heights + 1)
+    sin_phi, cos_phi = np.sin(phis), np.cos(phis)
+    thetas = (2 * np.arange(cams_per_height) - 1) / args.num_cams * num_heights * math.pi
+    cos_theta, sin_theta = np.cos(thetas), np.sin(thetas)
 
-            out_data['frames'].append(frame_data)
+    # Key the camera pose of every view on its own frame, so that all views
+    # can be rendered by a single animation render; frame f shows view f
+    scene = bpy.context.scene
+    camera.animation_data_clear()
+    for j in range(num_heights):
+        for i in range(cams_per_height):
+            camera.location = (10 * cos_theta[i] * sin_phi[j],
+                               10 * sin_theta[i] * sin_phi[j],
+                               10 * cos_phi[j])
+            logger.debug('camera at %s', camera.location)
+            camera.keyframe_insert('location', frame=cams_per_height * j + i)
+
+    # Now make some random objects, as seen from the first view
+    scene.frame_set(0)
+    objects, blender_objects = add_random_objects(num_objects, args, camera)
+    scene_struct['objects'] = objects
+    out_data['objects'] = objects_to_dicts(objects)
+
+    # This process renders every num_shards-th view, starting at shard_index
+    num_views = num_heights * cams_per_height
+    render_args.filepath = image_template
+    scene.frame_start = args.shard_index
+    scene.frame_end = num_views - 1
+    scene.frame_step = args.num_shards
+    frames = range(args.shard_index, num_views, args.num_shards)
+    if len(frames) > 0:
+        while True:
+            try:
+                bpy.ops.render.render(animation=True)
+                break
+            except Exception as e:
+                logger.warning('Rendering failed, retrying: %s', e)
+
+    for frame in frames:
+        scene.frame_set(frame)
+        out_data['frames'].append({
+            'file_path': os.path.relpath(render_args.frame_path(frame=frame), output_dir),
+            'rotation': math.radians(stepsize),
+            'transform_matrix': listify_matrix(camera.matrix_world)
+        })
 
     if output_blendfile is not None:
-        bpy.ops.wm.save_as_mainfile(filepath=output_blendfile)
+        # Save a copy so the session keeps working on the base scene
+        bpy.ops.wm.save_as_mainfile(filepath=output_blendfile, copy=True)
 
-    with open(os.path.join(args.output_dir, 'images/transforms.json'), 'w') as out_file:
-        json.dump(out_data, out_file, indent=4)
+    if args.num_shards > 1:
+        transforms_name = 'transforms_%d.json' % args.shard_index
+    else:
+        transforms_name = 'transforms.json'
+    write_json(os.path.join(output_dir, 'images', transforms_name), out_data)
 
+    # Restore the base scene for the next scene
+    camera.animation_data_clear()
+    for obj in blender_objects:
+        utils.delete_object(obj)
+    for lamp, location in lamp_rest_locations:
+        lamp.location = location
 
-def add_random_objects(num_objects, args, camera):
+
+# Number of times to re-place all objects of a scene before giving up; this is
+# only reached when the placement settings can (almost) never be satisfied
+MAX_SCENE_RETRIES = 1000
+
+Properties = namedtuple('Properties', ['color_name_to_rgba', 'color_items', 'material_mapping',
+                                       'object_mapping', 'size_mapping', 'shape_color_combos'])
+
+
+@functools.lru_cache(maxsize=4)
+def _load_properties(properties_json, shape_color_combos_json=None):
     """
-  Add random objects to the current blender scene
+  Load the property file (and optionally the shape/color combination file)
+  once per path, precomputing the lookup tables used to sample objects.
   """
-
-    # Load the property file
-    print("Load the property file")
-    with open(args.properties_json, 'r') as f:
+    with open(properties_json, 'r') as f:
         properties = json.load(f)
-        color_name_to_rgba = {}
-        for name, rgb in properties['colors'].items():
-            rgba = [float(c) / 255.0 for c in rgb] + [1.0]
-            color_name_to_rgba[name] = rgba
-        material_mapping = [(v, k) for k, v in properties['materials'].items()]
-        object_mapping = [(v, k) for k, v in properties['shapes'].items()]
-        size_mapping = list(properties['sizes'].items())
+    color_name_to_rgba = {}
+    for name, rgb in properties['colors'].items():
+        rgba = tuple(float(c) / 255.0 for c in rgb) + (1.0,)
+        color_name_to_rgba[name] = rgba
+    material_mapping = tuple((v, k) for k, v in properties['materials'].items())
+    object_mapping = tuple((v, k) for k, v in properties['shapes'].items())
+    size_mapping = tuple(properties['sizes'].items())
 
     shape_color_combos = None
-    if args.shape_color_combos_json is not None:
-        with open(args.shape_color_combos_json, 'r') as f:
-            shape_color_combos = list(json.load(f).items())
-
-    print('generating objects')
-    positions = []
-    objects = []
-    blender_objects = []
-    for i in range(num_objects):
-        # Choose a random size
-        size_name, r = random.choice(size_mapping)
-
-        # Try to place the object, ensuring that we don't intersect any existing
-        # objects and that we are more than the desired margin away from all existing
-        # objects along all cardinal directions.
-        num_tries = 0
-        while True:
+    if shape_color_combos_json is not None:
+        with open(shape_color_combos_json, 'r') as f:
+            shape_color_combos = tuple(json.load(f).items())
+
+    return Properties(color_name_to_rgba, tuple(color_name_to_rgba.items()), material_mapping,
+                      object_mapping, size_mapping, shape_color_combos)
+
+
+def _place_one(positions, n, r, xs, ys, min_dist):
+    """
+  Find a position for a new object of radius r among the candidate positions
+  (xs[k], ys[k]), given the first n rows (x, y, r) of positions. A candidate is
+  accepted if it is further than min_dist from all placed objects.
+
+  Returns the index of the first accepted candidate, or -1 if there is none.
+  """
+    placed_x, placed_y, placed_r = positions[:n].T
+    # One row per candidate, one column per placed object
+    dx = placed_x[None, :] - xs[:, None]
+    dy = placed_y[None, :] - ys[:, None]
+    good = np.all(np.hypot(dx, dy) - r - placed_r >= min_dist, axis=1)
+    accepted = np.flatnonzero(good)
+    return int(accepted[0]) if len(accepted) > 0 else -1
+
+
+if numba is not None:
+    @numba.njit(cache=True)
+    def _place_one_jit(positions, n, r, xs, ys, min_dist):
+        for k in range(xs.shape[0]):
+            ok = True
+            for m in range(n):
+                dx = positions[m, 0] - xs[k]
+                dy = positions[m, 1] - ys[k]
+                if math.sqrt(dx * dx + dy * dy) - r - positions[m, 2] < min_dist:
+                    ok = False
+                    break
+            if ok:
+                return k
+        return -1
+
+    # Same as _place_one, compiled to machine code; this pays off for scenes
+    # with many objects
+    _place_one = _place_one_jit
+
+
+def add_random_objects(num_objects, args, camera):
+    """
+  Add random objects to the current blender scene
+  """
+
+    props = _load_properties(args.properties_json, args.shape_color_combos_json)
+    color_name_to_rgba = props.color_name_to_rgba
+    object_mapping = props.object_mapping
+    shape_color_combos = props.shape_color_combos
+
+    # Seeded from random so that --seed also fixes the object positions
+    rng = np.random.default_rng(random.getrandbits(64))
+
+    logger.debug('generating %d objects', num_objects)
+    for attempt in range(1, MAX_SCENE_RETRIES + 1):
+        # Rows are (x, y, r) of the objects placed so far
+        positions = np.empty((num_objects, 3), dtype=np.float32)
+        # Object data is stored as a struct of arrays: one entry per object in
+        # each field; see objects_to_dicts for the per-object view
+        objects = {
+            'shape': [None] * num_objects,
+            'size': [None] * num_objects,
+            'material': [None] * num_objects,
+            '3d_coords': np.empty((num_objects, 3), dtype=np.float32),
+            'rotation': np.empty(num_objects, dtype=np.float32),
+            'pixel_coords': np.empty((num_objects, 3), dtype=np.float32),
+            'color': [None] * num_objects,
+        }
+        blender_objects = []
+        for i in range(num_objects):
+            # Choose a random size
+            size_name, r = random.choice(props.size_mapping)
+
+            # Try to place the object, ensuring that it is further than min_dist from
+            # all existing objects.
+            # All candidate positions are drawn up front and checked in one call
+            xs = rng.uniform(-3, 3, size=args.max_retries)
+            ys = rng.uniform(-3, 3, size=args.max_retries)
+            k = _place_one(positions, i, r, xs, ys, args.min_dist)
+            placed = k >= 0
+            if placed:
+                x, y = float(xs[k]), float(ys[k])
+
+            logger.debug('object %d: %d tries, placed: %s', i,
+                         k + 1 if placed else args.max_retries, placed)
             # If we try and fail to place an object too many times, then delete all
             # the objects in the scene and start over.
-            num_tries += 1
-            print(f'number of trials: {num_tries}')
-            if num_tries > args.max_retries:
+            if not placed:
+                logger.warning('Could not place object %d of %d; re-placing all objects '
+                               '(attempt %d of %d)', i + 1, num_objects, attempt,
+                               MAX_SCENE_RETRIES)
                 for obj in blender_objects:
                     utils.delete_object(obj)
-                return add_random_objects(num_objects, args, camera)
-            x = random.uniform(-3, 3)
-            y = random.uniform(-3, 3)
-            # Check to make sure the new object is further than min_dist from all
-            # other objects, and further than margin along the four cardinal directions
-            dists_good = True
-            for (xx, yy, rr) in positions:
-                dx, dy = x - xx, y - yy
-                dist = math.sqrt(dx * dx + dy * dy)
-                if dist - r - rr < args.min_dist:
-                    dists_good = False
-                    break
-
-            if dists_good:
                 break
 
-        print('choose random color and shape')
-        # Choose random color and shape
-        if shape_color_combos is None:
-            obj_name, obj_name_out = random.choice(object_mapping)
-            color_name, rgba = random.choice(list(color_name_to_rgba.items()))
+            # Choose random color and shape
+            if shape_color_combos is None:
+                obj_name, obj_name_out = random.choice(object_mapping)
+                color_name, rgba = random.choice(props.color_items)
+            else:
+                obj_name_out, color_choices = random.choice(shape_color_combos)
+                color_name = random.choice(color_choices)
+                obj_name = [k for k, v in object_mapping if v == obj_name_out][0]
+                rgba = color_name_to_rgba[color_name]
+
+            # For cube, adjust the size a bit
+            if obj_name == 'Cube':
+                r /= math.sqrt(2)
+
+            # Choose random orientation for the object.
+            theta = 360.0 * random.random()
+
+            # Actually add the object to the scene
+            utils.add_object(os.path.join(args.output_dir, args.shape_dir), obj_name, r, (x, y), theta=theta)
+            obj = bpy.context.object
+            utils.set_layer(obj, -1, 0)
+            blender_objects.append(obj)
+            positions[i] = (x, y, r)
+
+            # Attach a random material
+            mat_name, mat_name_out = random.choice(props.material_mapping)
+            utils.add_material(mat_name, Color=rgba)
+
+            # Record data about the object in the scene data structure
+            objects['shape'][i] = obj_name_out
+            objects['size'][i] = size_name
+            objects['material'][i] = mat_name_out
+            objects['3d_coords'][i] = obj.location
+            objects['rotation'][i] = theta
+            objects['color'][i] = color_name
         else:
-            obj_name_out, color_choices = random.choice(shape_color_combos)
-            color_name = random.choice(color_choices)
-            obj_name = [k for k, v in object_mapping if v == obj_name_out][0]
-            rgba = color_name_to_rgba[color_name]
-
-        # For cube, adjust the size a bit
-        if obj_name == 'Cube':
-            r /= math.sqrt(2)
-
-        # Choose random orientation for the object.
-        theta = 360.0 * random.random()
-
-        # Actually add the object to the scene
-        utils.add_object(os.path.join(args.output_dir, args.shape_dir), obj_name, r, (x, y), theta=theta)
-        obj = bpy.context.object
-        utils.set_layer(obj, -1, 0)
-        blender_objects.append(obj)
-        positions.append((x, y, r))
-
-        # Attach a random material
-        mat_name, mat_name_out = random.choice(material_mapping)
-        utils.add_material(mat_name, Color=rgba)
-
-        # Record data about the object in the scene data structure
-        pixel_coords = utils.get_camera_coords(camera, obj.location)
-        objects.append({
-            'shape': obj_name_out,
-            'size': size_name,
-            'material': mat_name_out,
-            '3d_coords': tuple(obj.location),
-            'rotation': theta,
-            'pixel_coords': pixel_coords,
-            'color': color_name,
-        })
+            break
+    else:
+        raise RuntimeError('Failed to place %d objects after %d attempts; try a smaller '
+                           '--max_objects or --min_dist, or a larger --max_retries'
+                           % (num_objects, MAX_SCENE_RETRIES))
+
+    # Project all objects into the camera at once
+    objects['pixel_coords'][:] = utils.get_camera_coords_batch(camera, objects['3d_coords'])
 
     # Check that all objects are at least partially visible in the rendered image
     # all_visible = check_visibility(blender_objects, args.min_pixels_per_object)
@@ -395,6 +602,24 @@ def add_random_objects(num_objects, args, camera):
     return objects, blender_objects
 
 
+def objects_to_dicts(objects):
+    """
+  Convert the struct-of-arrays object data returned by add_random_objects into
+  a list with one dict per object, as stored in the output JSON.
+  """
+    return [{
+        'shape': shape,
+        'size': size,
+        'material': material,
+        '3d_coords': coords.tolist(),
+        'rotation': float(rotation),
+        'pixel_coords': [int(px), int(py), float(pz)],
+        'color': color,
+    } for shape, size, material, coords, rotation, (px, py, pz), color in zip(
+        objects['shape'], objects['size'], objects['material'], objects['3d_coords'],
+        objects['rotation'], objects['pixel_coords'], objects['color'])]
+
+
 def compute_all_relationships(scene_struct, eps=0.2):
     """
   Computes relationships between all pairs of objects in the scene.
@@ -405,20 +630,15 @@ def compute_all_relationships(scene_struct, eps=0.2):
   object j is left of object i.
   """
     all_relationships = {}
+    coords = np.asarray(scene_struct['objects']['3d_coords'], dtype=np.float32).reshape(-1, 3)
+    # diffs[i, j] is the offset from object i to object j
+    diffs = coords[None, :, :] - coords[:, None, :]
+    not_self = ~np.eye(len(coords), dtype=bool)
     for name, direction_vec in scene_struct['directions'].items():
         if name == 'above' or name == 'below': continue
-        all_relationships[name] = []
-        for i, obj1 in enumerate(scene_struct['objects']):
-            coords1 = obj1['3d_coords']
-            related = set()
-            for j, obj2 in enumerate(scene_struct['objects']):
-                if obj1 == obj2: continue
-                coords2 = obj2['3d_coords']
-                diff = [coords2[k] - coords1[k] for k in [0, 1, 2]]
-                dot = sum(diff[k] * direction_vec[k] for k in [0, 1, 2])
-                if dot > eps:
-                    related.add(j)
-            all_relationships[name].append(sorted(list(related)))
+        dots = diffs @ np.asarray(direction_vec, dtype=np.float32)
+        related = (dots > eps) & not_self
+        all_relationships[name] = [np.flatnonzero(row).tolist() for row in related]
     return all_relationships
 
 
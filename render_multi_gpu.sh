@@ -0,0 +1,34 @@
+#!/bin/bash
+# Render a scene on several GPUs in parallel. One Blender process is started
+# per GPU; process k renders on GPU k and renders every NUM_GPUS-th camera
+# view starting at view k. All processes share the same random seed so that
+# they render the same scene.
+#
+# Usage:
+#   ./render_multi_gpu.sh NUM_GPUS [arguments to render_images.py]
+#
+# Set $BLENDER to use a Blender binary that is not on the PATH, and $SEED to
+# choose the random seed.
+
+NUM_GPUS=${1:?"usage: $0 NUM_GPUS [arguments to render_images.py]"}
+shift
+BLENDER=${BLENDER:-blender}
+SEED=${SEED:-$RANDOM}
+
+PIDS=()
+for ((k = 0; k < NUM_GPUS; k++)); do
+  "$BLENDER" --background -noaudio --python render_images.py -- \
+    --use_gpu 1 --gpu_index $k --shard_index $k --num_shards $NUM_GPUS \
+    --seed $SEED "$@" &
+  PIDS+=($!)
+done
+
+# Fail if any shard failed, since its views are then missing
+STATUS=0
+for k in "${!PIDS[@]}"; do
+  if ! wait "${PIDS[$k]}"; then
+    echo "Shard $k failed" >&2
+    STATUS=1
+  fi
+done
+exit $STATUS
@@ -6,7 +6,9 @@
 # of patent rights can be found in the PATENTS file in the same directory.
 
 import sys, random, os
+import numpy as np
 import bpy, bpy_extras
+from mathutils import Vector
 
 
 """
@@ -35,11 +37,17 @@ def parse_args(parser, argv=None):
 
 # I wonder if there's a better way to do this?
 def delete_object(obj):
-  """ Delete a specified blender object """
-  for o in bpy.data.objects:
+  """ Delete a specified blender object, and its mesh if nothing else uses it """
+  data = obj.data
+  # Only objects in the view layer can be selected; bpy.data.objects also holds
+  # the shape templates cached by load_shape
+  for o in bpy.context.view_layer.objects:
     o.select_set(False)
   obj.select_set(True)
   bpy.ops.object.delete()
+  # add_object gives every object its own mesh copy; free it with the object
+  if isinstance(data, bpy.types.Mesh) and data.users == 0:
+    bpy.data.meshes.remove(data)
 
 
 def get_camera_coords(cam, pos):
@@ -65,6 +73,90 @@ def get_camera_coords(cam, pos):
   return (px, py, z)
 
 
+def get_camera_coords_batch(cam, positions):
+  """
+  Vectorized version of get_camera_coords for many points at once; the camera
+  matrix and frame are only read once.
+
+  Inputs:
+  - cam: Camera object
+  - positions: Array of shape (N, 3) giving 3D world-space positions
+
+  Returns an array of shape (N, 3) whose rows are (px, py, pz) as returned by
+  get_camera_coords.
+  """
+  scene = bpy.context.scene
+  positions = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+
+  # Same computation as bpy_extras.object_utils.world_to_camera_view
+  world_to_cam = np.array(cam.matrix_world.normalized().inverted())
+  local = positions @ world_to_cam[:3, :3].T + world_to_cam[:3, 3]
+  z = -local[:, 2]
+  frame = [np.array(v) for v in cam.data.view_frame(scene=scene)]
+  lx, ly = local[:, 0], local[:, 1]
+  perspective = cam.data.type != 'ORTHO'
+  if perspective:
+    # Compare against the camera frame at unit depth
+    frame = [v / -v[2] for v in frame]
+    with np.errstate(divide='ignore', invalid='ignore'):
+      lx, ly = lx / z, ly / z
+  min_x, max_x = frame[2][0], frame[1][0]
+  min_y, max_y = frame[1][1], frame[0][1]
+  x = (lx - min_x) / (max_x - min_x)
+  y = (ly - min_y) / (max_y - min_y)
+  if perspective:
+    # Points at zero depth map to the center of the image
+    x = np.where(z == 0, 0.5, x)
+    y = np.where(z == 0, 0.5, y)
+
+  scale = scene.render.resolution_percentage / 100.0
+  w = int(scale * scene.render.resolution_x)
+  h = int(scale * scene.render.resolution_y)
+  px = np.rint(x * w)
+  py = np.rint(h - y * h)
+  return np.column_stack((px, py, z))
+
+
+def enable_gpus(device_types=('OPTIX', 'CUDA', 'HIP', 'METAL', 'ONEAPI'), gpu_index=None):
+  """
+  Configure Cycles to render on the GPU. The first compute device type in
+  device_types for which Blender finds at least one device is selected, and
+  every device of that type is enabled; all other devices are disabled.
+
+  - gpu_index: if given, only the gpu_index-th device of the selected type is
+    enabled. This lets several Blender processes share a machine with one GPU
+    each.
+
+  Returns the name of the selected compute device type.
+  """
+  cycles_prefs = bpy.context.preferences.addons['cycles'].preferences
+  cycles_prefs.refresh_devices()
+  for device_type in device_types:
+    if not any(d.type == device_type for d in cycles_prefs.devices):
+      continue
+    try:
+      cycles_prefs.compute_device_type = device_type
+      break
+    except TypeError:
+      # This Blender build does not support the device type
+      pass
+  else:
+    raise RuntimeError('No GPU found for any of the compute device types %s'
+                       % (device_types,))
+
+  gpus = [d for d in cycles_prefs.devices
+          if d.type == cycles_prefs.compute_device_type]
+  if gpu_index is not None and not 0 <= gpu_index < len(gpus):
+    raise ValueError('gpu_index %d is out of range; found %d %s devices'
+                     % (gpu_index, len(gpus), cycles_prefs.compute_device_type))
+  for device in cycles_prefs.devices:
+    device.use = False
+  for i, device in enumerate(gpus):
+    device.use = (gpu_index is None or i == gpu_index)
+  bpy.context.scene.cycles.device = 'GPU'
+  return cycles_prefs.compute_device_type
+
+
 def set_layer(obj, original_layer_idx, layer_idx):
   """ Move an object to a particular layer """
   # Set the target layer to True first because an object must always be on
@@ -82,36 +174,74 @@ def set_layer(obj, original_layer_idx, layer_idx):
   #   obj.cycles_visibility[i] = (i == layer_idx)
 
 
+# Template objects loaded by load_shape, keyed by the path of their .blend file
+_shape_cache = {}
+
+
+def load_shape(object_dir, name):
+  """
+  Load the object "$name" from the file "$object_dir/$name.blend" the first
+  time it is requested. The object is kept as a template that is not linked to
+  any scene, so all of its object-level state (modifiers, material slots,
+  visibility flags, custom properties) is preserved for add_object.
+
+  Returns the template object.
+  """
+  filepath = os.path.join(object_dir, '%s.blend' % name)
+  if filepath not in _shape_cache:
+    with bpy.data.libraries.load(filepath, link=False) as (data_from, data_to):
+      data_to.objects = [name]
+    template = data_to.objects[0]
+    # Keep the template alive although no scene uses it
+    template.use_fake_user = True
+    _shape_cache[filepath] = template
+  return _shape_cache[filepath]
+
+
+def load_shapes(shape_dir):
+  """
+  Preload all shapes in a directory with load_shape, so that add_object never
+  has to read a .blend file.
+  """
+  for fn in os.listdir(shape_dir):
+    if not fn.endswith('.blend'): continue
+    load_shape(shape_dir, os.path.splitext(fn)[0])
+
+
 def add_object(object_dir, name, scale, loc, theta=0):
   """
   Load an object from a file. We assume that in the directory object_dir, there
   is a file named "$name.blend" which contains a single object named "$name"
-  that has unit size and is centered at the origin.
+  that has unit size and is centered at the origin. Each file is only read
+  once; later objects of the same shape are copies of the cached template.
 
   - scale: scalar giving the size that the object should be in the scene
   - loc: tuple (x, y) giving the coordinates on the ground plane where the
     object should be placed.
   """
+  template = load_shape(object_dir, name)
+
   # First figure out how many of this object are already in the scene so we can
-  # give the new object a unique name
+  # give the new object a unique name; the cached templates don't count
   count = 0
   for obj in bpy.data.objects:
-    if obj.name.startswith(name):
+    if obj.name.startswith(name) and not obj.use_fake_user:
       count += 1
-
-  filename = os.path.join(object_dir, '%s.blend' % name, 'Object', name)
-  bpy.ops.wm.append(filename=filename)
-
-  # Give it a new name to avoid conflicts
   new_name = '%s_%d' % (name, count)
-  bpy.data.objects[name].name = new_name
+
+  # Each object gets its own copy of the mesh since materials are attached to it
+  obj = template.copy()
+  obj.use_fake_user = False
+  obj.data = template.data.copy()
+  obj.name = new_name
+  bpy.context.collection.objects.link(obj)
 
   # Set the new object as active, then rotate, scale, and translate it
   x, y = loc
-  bpy.context.view_layer.objects.active = bpy.data.objects[new_name]
-  bpy.context.object.rotation_euler[2] = theta
-  bpy.ops.transform.resize(value=(scale, scale, scale))
-  bpy.ops.transform.translate(value=(x, y, scale))
+  bpy.context.view_layer.objects.active = obj
+  obj.rotation_euler[2] = theta
+  obj.scale = template.scale * scale
+  obj.location = template.location + Vector((x, y, scale))
 
 
 def load_materials(material_dir):
@@ -127,11 +257,36 @@ def load_materials(material_dir):
     bpy.ops.wm.append(filename=filepath)
 
 
+# Materials created by add_material, keyed by their name and properties
+_material_cache = {}
+
+
+def _freeze(value):
+  """ Make a property value such as an RGBA color usable as a dict key """
+  if isinstance(value, (str, bytes)):
+    return value
+  try:
+    return tuple(value)
+  except TypeError:
+    return value
+
+
 def add_material(name, **properties):
   """
   Create a new material and assign it to the active object. "name" should be the
   name of a material that has been previously loaded using load_materials.
+
+  Materials are cached, so objects with the same material name and properties
+  share a single material instead of each building its own node tree. The
+  cache assumes the same blend file stays open for the whole run.
   """
+  key = (name,) + tuple(sorted((k, _freeze(v)) for k, v in properties.items()))
+  obj = bpy.context.active_object
+  if key in _material_cache:
+    assert len(obj.data.materials) == 0
+    obj.data.materials.append(_material_cache[key])
+    return
+
   # Figure out how many materials are already in the scene
   mat_count = len(bpy.data.materials)
 
@@ -147,7 +302,6 @@ def add_material(name, **properties):
 
   # Attach the new material to the active object
   # Make sure it doesn't already have materials
-  obj = bpy.context.active_object
   assert len(obj.data.materials) == 0
   obj.data.materials.append(mat)
 
@@ -177,4 +331,5 @@ def add_material(name, **properties):
       group_node.outputs['Shader'],
       output_node.inputs['Surface'],
   )
+  _material_cache[key] = mat
 